@@ -1,7 +1,8 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Query
 from dotenv import load_dotenv
-from national_rail_api import get_raw_train_services
+from national_rail_api import get_raw_train_services, close_client
 
 # Load environment variables
 load_dotenv()
@@ -9,7 +10,12 @@ load_dotenv()
 NATIONAL_RAIL_API_TOKEN = os.getenv("NATIONAL_RAIL_API_TOKEN")
 USER_AGENT = os.getenv("USER_AGENT", "train-bot-app/0.0.1")
 
-app = FastAPI(title="Train Schedule API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_client()
+
+app = FastAPI(title="Train Schedule API", lifespan=lifespan)
 
 @app.get("/api/schedule")
 async def get_schedule(
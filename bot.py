@@ -5,9 +5,9 @@ from functools import wraps
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, ContextTypes, CallbackQueryHandler, TypeHandler
 from sqlite_persistence import SQLitePersistence
-from national_rail_api import fetch_train_schedule
+from national_rail_api import CRS_RE, fetch_train_schedule, close_client
 
 # Load environment variables
 load_dotenv()
@@ -16,13 +16,19 @@ load_dotenv()
 NATIONAL_RAIL_API_TOKEN = os.getenv("NATIONAL_RAIL_API_TOKEN")
 USER_AGENT = os.getenv("USER_AGENT", "train-bot-app/0.0.1") # Default user agent
 
+# Telegram HTTP connection pools. getUpdates gets its own pool so long polling never starves replies.
+CONNECTION_POOL_SIZE = int(os.getenv("CONNECTION_POOL_SIZE", "64"))
+POOL_TIMEOUT = float(os.getenv("POOL_TIMEOUT", "10"))
+GET_UPDATES_CONNECTION_POOL_SIZE = int(os.getenv("GET_UPDATES_CONNECTION_POOL_SIZE", "8"))
+GET_UPDATES_POOL_TIMEOUT = float(os.getenv("GET_UPDATES_POOL_TIMEOUT", "60"))
+
 # --- Authorization Setup ---
 AUTHORIZED_USER_IDS_STR = os.getenv("AUTHORIZED_USER_IDS", "")
 if not AUTHORIZED_USER_IDS_STR:
     logging.warning("AUTHORIZED_USER_IDS is not set. The bot will be open to everyone.")
-    AUTHORIZED_USER_IDS = set()
+    AUTHORIZED_USER_IDS = frozenset()
 else:
-    AUTHORIZED_USER_IDS = {int(user_id.strip()) for user_id in AUTHORIZED_USER_IDS_STR.split(',') if user_id.strip()}
+    AUTHORIZED_USER_IDS = frozenset(int(user_id.strip()) for user_id in AUTHORIZED_USER_IDS_STR.split(',') if user_id.strip())
 
 # Enable logging
 logging.basicConfig(
@@ -31,19 +37,63 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def restricted(func):
+# --- Static Replies ---
+
+WELCOME_TEXT = (
+    "Welcome to the Train Schedule Bot!\n\n"
+    "I can help you check train schedules for your commute.\n\n"
+    "**Configuration:**\n"
+    "/set_home <CRS> - Set your home station (e.g., /set_home KGX)\n"
+    "/set_office <CRS> - Set your office station (e.g., /set_office EUS)\n\n"
+    "**On-Demand Schedules:**\n"
+    "/now - Get schedule now (choose direction).\n"
+    "/nowt - Get schedule: Home to Office.\n"
+    "/nowf - Get schedule: Office to Home.\n\n"
+    "**Scheduled Notifications:**\n"
+    "/set_to_slot <HH:mm AM/PM> - Schedule morning commute (e.g., /set_to_slot 08:30 AM)\n"
+    "/set_from_slot <HH:mm AM/PM> - Schedule evening commute (e.g., /set_from_slot 05:30 PM)\n"
+)
+
+NOW_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Home -> Office", callback_data='home_to_office')],
+    [InlineKeyboardButton("Office -> Home", callback_data='office_to_home')],
+])
+
+
+async def auth_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Rejects updates from users outside AUTHORIZED_USER_IDS before any handler runs.
+    Registered in a group that runs first, and only when authorized IDs are configured.
+    """
+    user = update.effective_user
+    if user and user.id in AUTHORIZED_USER_IDS:
+        return
+
+    user_id = user.id if user else None
+    logging.warning(f"Unauthorized access denied for user_id {user_id}.")
+    if update.callback_query:
+        await update.callback_query.answer("Sorry, you are not authorized to use this bot.", show_alert=True)
+    elif update.message and update.message.text and update.message.text.startswith('/'):
+        text = "Sorry, you are not authorized to use this bot."
+        if update.message.text.startswith('/start'):
+            text += f"\nIf you'd like to request access, please provide the admin with your User ID: `{user_id}`"
+        await update.message.reply_text(text)
+    raise ApplicationHandlerStop
+
+
+def requires_crs(func):
     """
-    Restricts access to a command handler to authorized user IDs.
-    If the list of authorized IDs is empty, the bot is considered public.
+    Ensures both home and office CRS codes are set before running a handler.
+    The codes are passed to the handler as `home_crs` and `office_crs` arguments.
     """
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id
-        if AUTHORIZED_USER_IDS and user_id not in AUTHORIZED_USER_IDS:
-            logging.warning(f"Unauthorized access denied for user_id {user_id}.")
-            await update.message.reply_text("Sorry, you are not authorized to use this bot.")
+        home_crs = context.user_data.get('home_crs')
+        office_crs = context.user_data.get('office_crs')
+        if not home_crs or not office_crs:
+            await update.message.reply_text("Please set both home and office CRS codes first using /set_home and /set_office.")
             return
-        return await func(update, context, *args, **kwargs)
+        return await func(update, context, home_crs, office_crs, *args, **kwargs)
     return wrapped
 
 
@@ -51,49 +101,24 @@ def restricted(func):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message and explains the bot's functionality."""
-    user_id = update.effective_user.id
-    if AUTHORIZED_USER_IDS and user_id not in AUTHORIZED_USER_IDS:
-        logging.warning(f"Unauthorized user {user_id} tried to start the bot.")
-        await update.message.reply_text(
-            "Sorry, you are not authorized to use this bot.\n"
-            f"If you'd like to request access, please provide the admin with your User ID: `{user_id}`"
-        )
-        return
-
-    welcome_text = (
-        "Welcome to the Train Schedule Bot!\n\n"
-        "I can help you check train schedules for your commute.\n\n"
-        "**Configuration:**\n"
-        "/set_home <CRS> - Set your home station (e.g., /set_home KGX)\n"
-        "/set_office <CRS> - Set your office station (e.g., /set_office EUS)\n\n"
-        "**On-Demand Schedules:**\n"
-        "/now - Get schedule now (choose direction).\n"
-        "/nowt - Get schedule: Home to Office.\n"
-        "/nowf - Get schedule: Office to Home.\n\n"
-        "**Scheduled Notifications:**\n"
-        "/set_to_slot <HH:mm AM/PM> - Schedule morning commute (e.g., /set_to_slot 08:30 AM)\n"
-        "/set_from_slot <HH:mm AM/PM> - Schedule evening commute (e.g., /set_from_slot 05:30 PM)\n"
-    )
-    await update.message.reply_text(welcome_text)
+    await update.message.reply_text(WELCOME_TEXT)
 
-@restricted
 async def set_home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sets the user's home station."""
     try:
         crs_code = context.args[0].upper()
-        if len(crs_code) != 3 or not crs_code.isalpha():
+        if not CRS_RE.match(crs_code):
             raise ValueError
         context.user_data['home_crs'] = crs_code
         await update.message.reply_text(f"Home station set to {crs_code}")
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /set_home <3_LETTER_CRS_CODE>")
 
-@restricted
 async def set_office(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sets the user's office station."""
     try:
         crs_code = context.args[0].upper()
-        if len(crs_code) != 3 or not crs_code.isalpha():
+        if not CRS_RE.match(crs_code):
             raise ValueError
         context.user_data['office_crs'] = crs_code
         await update.message.reply_text(f"Office station set to {crs_code}")
@@ -119,76 +144,44 @@ async def _set_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, slot_typ
     except ValueError:
         await update.message.reply_text("Invalid time format. Please use HH:mm AM/PM (e.g., 08:30 AM).")
 
-@restricted
 async def set_to_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sets the morning commute time slot (home to office)."""
     await _set_slot(update, context, "to")
 
-@restricted
 async def set_from_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sets the evening commute time slot (office to home)."""
     await _set_slot(update, context, "from")
 
-@restricted
-async def now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@requires_crs
+async def now(update: Update, context: ContextTypes.DEFAULT_TYPE, home_crs: str, office_crs: str) -> None:
     """Provides an on-demand schedule."""
-    home_crs = context.user_data.get('home_crs')
-    office_crs = context.user_data.get('office_crs')
+    await update.message.reply_text('Please choose a direction:', reply_markup=NOW_KEYBOARD)
 
-    if not home_crs or not office_crs:
-        await update.message.reply_text("Please set both home and office CRS codes first.")
-        return
-
-    keyboard = [
-        [InlineKeyboardButton("Home -> Office", callback_data='home_to_office')],
-        [InlineKeyboardButton("Office -> Home", callback_data='office_to_home')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text('Please choose a direction:', reply_markup=reply_markup)
-
-@restricted
-async def nowt_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@requires_crs
+async def nowt_command(update: Update, context: ContextTypes.DEFAULT_TYPE, home_crs: str, office_crs: str) -> None:
     """Gets the train schedule from Home to Office."""
-    home_crs = context.user_data.get('home_crs')
-    office_crs = context.user_data.get('office_crs')
-
-    if not home_crs or not office_crs:
-        await update.message.reply_text("Please set both home and office CRS codes first using /set_home and /set_office.")
-        return
-
     route_text = "Home to Office"
-    await update.message.reply_text(f"Fetching schedule for {route_text}...")
-    
-    schedule_text = await fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, home_crs, office_crs)
+    # Send the interim reply while the schedule is being fetched
+    _, schedule_text = await asyncio.gather(
+        update.message.reply_text(f"Fetching schedule for {route_text}..."),
+        fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, home_crs, office_crs),
+    )
     await update.message.reply_text(schedule_text)
 
-@restricted
-async def nowf_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@requires_crs
+async def nowf_command(update: Update, context: ContextTypes.DEFAULT_TYPE, home_crs: str, office_crs: str) -> None:
     """Gets the train schedule from Office to Home."""
-    home_crs = context.user_data.get('home_crs')
-    office_crs = context.user_data.get('office_crs')
-
-    if not home_crs or not office_crs:
-        await update.message.reply_text("Please set both home and office CRS codes first using /set_home and /set_office.")
-        return
-
     route_text = "Office to Home"
-    await update.message.reply_text(f"Fetching schedule for {route_text}...")
-    
-    schedule_text = await fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, office_crs, home_crs)
+    # Send the interim reply while the schedule is being fetched
+    _, schedule_text = await asyncio.gather(
+        update.message.reply_text(f"Fetching schedule for {route_text}..."),
+        fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, office_crs, home_crs),
+    )
     await update.message.reply_text(schedule_text)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles button presses for the /now command."""
     query = update.callback_query
-    user_id = query.from_user.id
-
-    # Restrict access for callback queries as well
-    if AUTHORIZED_USER_IDS and user_id not in AUTHORIZED_USER_IDS:
-        logging.warning(f"Unauthorized access denied for user_id {user_id} via callback query.")
-        await query.answer("Sorry, you are not authorized to use this bot.", show_alert=True)
-        return
-
     await query.answer()
 
     home_crs = context.user_data.get('home_crs')
@@ -204,26 +197,71 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await query.edit_message_text(text="Invalid selection.")
         return
 
-    await query.edit_message_text(text=f"Fetching schedule for {route_text}...")
-    
-    schedule_text = await fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, origin, destination)
+    _, schedule_text = await asyncio.gather(
+        query.edit_message_text(text=f"Fetching schedule for {route_text}..."),
+        fetch_train_schedule(NATIONAL_RAIL_API_TOKEN, USER_AGENT, origin, destination),
+    )
     await context.bot.send_message(chat_id=query.message.chat_id, text=schedule_text)
 
 
 # --- Main Application Setup ---
 
+async def post_init(application: Application) -> None:
+    """Starts background work once the Application is initialized."""
+    if application.persistence:
+        application.persistence.start_flush_loop()
+
+async def post_stop(application: Application) -> None:
+    """Stops background work before the Application shuts down."""
+    if application.persistence:
+        await application.persistence.stop_flush_loop()
+
+async def post_shutdown(application: Application) -> None:
+    """Releases resources that live outside of the Application."""
+    await close_client()
+    # Persistence has been flushed by Application.shutdown() at this point.
+    if application.persistence:
+        application.persistence.close()
+
+
 def main() -> None:
     """Run the bot."""
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables.")
         return
+    if not NATIONAL_RAIL_API_TOKEN:
+        logger.error("NATIONAL_RAIL_API_TOKEN not found in environment variables.")
+        return
+
+    # Use the faster libuv-based event loop where it's available (not on Windows).
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop.")
 
     # Set up persistence with the new SQLite-based class.
     persistence = SQLitePersistence(filepath="bot_data.db")
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(token).persistence(persistence).build()
+    application = (
+        Application.builder()
+        .token(token)
+        .persistence(persistence)
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .pool_timeout(POOL_TIMEOUT)
+        .get_updates_connection_pool_size(GET_UPDATES_CONNECTION_POOL_SIZE)
+        .get_updates_pool_timeout(GET_UPDATES_POOL_TIMEOUT)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Reject unauthorized users once per update, before any command handler runs
+    if AUTHORIZED_USER_IDS:
+        application.add_handler(TypeHandler(Update, auth_gate), group=-1)
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -1,40 +1,154 @@
 import asyncio
-import requests
-from typing import Dict, Any, List, Union
+import functools
+import re
+import httpx
+from datetime import datetime
+from cachetools import TTLCache
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson has no wheel for this platform; fall back to the stdlib parser
+    import json
+    _json_loads = json.loads
+
+# LDBWS (Live Departure Board Web Service) endpoints live under this prefix; requests use paths relative to it.
+API_BASE_URL = "https://api1.raildata.org.uk/1010-live-departure-board-dep1_2/LDBWS/api/20220120"
+
+# CRS station codes are exactly three letters, e.g. KGX
+CRS_RE = re.compile(r"^[A-Z]{3}$")
+
+# Shared HTTP client so TCP/TLS connections to the API host are reused across calls.
+# HTTP/2 lets concurrent requests share one connection where the server supports it.
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Returns the shared HTTP client, creating it lazily on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=75),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Closes the shared HTTP client. Should be called on application shutdown."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Departure boards refresh roughly once a minute, so recent results can be shared between users.
+SCHEDULE_CACHE_TTL = 30  # seconds
+_schedule_cache: TTLCache = TTLCache(maxsize=512, ttl=SCHEDULE_CACHE_TTL)
+
+# Last good response per route, served (marked stale) when the API can't be reached.
+STALE_CACHE_TTL = 30 * 60  # seconds
+_stale_cache: TTLCache = TTLCache(maxsize=512, ttl=STALE_CACHE_TTL)
+
+# Requests currently in flight, so concurrent lookups for the same route share one call.
+_inflight: Dict[Tuple[str, str], "asyncio.Task[Dict[str, Any]]"] = {}
 
 async def get_raw_train_services(api_token: str, user_agent_str: str, origin: str, destination: str) -> Dict[str, Any]:
-    """Fetches raw train services from the National Rail API."""
+    """
+    Fetches raw train services from the National Rail API.
+    Successful responses are cached per (origin, destination) for SCHEDULE_CACHE_TTL seconds,
+    and concurrent callers for the same route await a single in-flight request.
+    If the request fails, the last good response from the past STALE_CACHE_TTL seconds is
+    returned instead, with a "stale_as_of" timestamp added.
+    Station codes must already be upper case; malformed ones are rejected without a request.
+    """
     if not api_token:
         return {"error": "National Rail API token is missing."}
-
-    url = f"https://api1.raildata.org.uk/1010-live-departure-board-dep1_2/LDBWS/api/20220120/GetDepBoardWithDetails/{origin}"
-    params = {
-        "filterCrs": destination,
-        "filterType": "to",
-        "numRows": 10,
-        "timeWindow": 120,
-    }
-    headers = {
-        "x-apikey": api_token,
-        'user-agent': user_agent_str
-    }
+    if not (origin and destination and CRS_RE.match(origin) and CRS_RE.match(destination)):
+        return {"error": "Invalid station code.", "status_code": 400}
+
+    key = (origin, destination)
+    cached = _schedule_cache.get(key)
+    if cached is not None:
+        return cached
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_request_train_services(api_token, user_agent_str, origin, destination))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    # Shield the shared request so one caller being cancelled doesn't fail the others.
+    data = await asyncio.shield(task)
+    if "error" not in data:
+        _schedule_cache[key] = data
+        _stale_cache[key] = (data, datetime.now())
+    elif data.get("status_code") != 401:
+        # Serve the last good board rather than an error, but never hide a bad token
+        stale = _stale_cache.get(key)
+        if stale is not None:
+            stale_data, fetched_at = stale
+            return {**stale_data, "stale_as_of": fetched_at}
+    return data
+
+async def _request_train_services(api_token: str, user_agent_str: str, origin: str, destination: str) -> Dict[str, Any]:
+    """Performs the departure board request, mapping failures to an error dict."""
+    url, params = _build_request(origin, destination)
+    headers = _request_headers(api_token, user_agent_str)
 
     try:
-        response = await asyncio.to_thread(requests.get, url, params=params, headers=headers)
+        response = await _get_client().get(url, params=params, headers=headers)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as e:
+        return _json_loads(response.content)
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
             return {"error": "Authentication failed. Please check your API token.", "status_code": 401}
         return {"error": f"Problem reaching the schedule service (HTTP {e.response.status_code}).", "status_code": e.response.status_code}
-    except requests.exceptions.RequestException:
+    except httpx.RequestError:
         return {"error": "Could not connect to the train schedule service."}
     except Exception:
         return {"error": "An unexpected error occurred while fetching the schedule."}
 
+@functools.lru_cache(maxsize=256)
+def _build_request(origin: str, destination: str) -> Tuple[str, Tuple[Tuple[str, Union[str, int]], ...]]:
+    """Builds the departure board path (relative to the client's base URL) and query parameters once per route."""
+    url = f"/GetDepBoardWithDetails/{origin}"
+    params = (
+        ("filterCrs", destination),
+        ("filterType", "to"),
+        ("numRows", 10),
+        ("timeWindow", 120),
+    )
+    return url, params
+
+@functools.lru_cache(maxsize=8)
+def _request_headers(api_token: str, user_agent_str: str) -> Dict[str, str]:
+    """Builds the request headers once per token/user agent pair. Callers must not mutate the result."""
+    return {
+        "x-apikey": api_token,
+        'user-agent': user_agent_str
+    }
+
+def _format_service(service_type: str, service: Dict[str, Any]) -> str:
+    """Formats one train or bus service as a line of the schedule."""
+    std = service.get("std")
+    etd = service.get("etd")
+    emoji = "🚌" if service_type == "bus" else "🚆"
+
+    # Only the part after std varies, so build that suffix once and format the line in one go
+    status = (
+        " - CANCELLED" if service.get("isCancelled", False)
+        else f" (exp. {etd})" if etd and etd.lower() != "on time"
+        else f" -> {etd}"
+    )
+    return f"{emoji} {std}{status}, Plat: {service.get('platform', 'TBA')}, Op: {service.get('operator')}"
+
 async def fetch_train_schedule(api_token: str, user_agent_str: str, origin: str, destination: str) -> str:
     """Fetches the schedule (trains & replacement buses) and returns a formatted string for the Telegram bot."""
-    import re
+    # Codes may be missing (None), e.g. when an old /now keyboard is pressed after the user's data is gone
+    origin, destination = (origin or "").upper(), (destination or "").upper()
     data = await get_raw_train_services(api_token, user_agent_str, origin, destination)
 
     if "error" in data:
@@ -43,46 +157,29 @@ async def fetch_train_schedule(api_token: str, user_agent_str: str, origin: str,
     raw_trains = data.get("trainServices") or []
     raw_buses = data.get("busServices") or []
 
-    trains = [{**s, "service_type": "train"} for s in raw_trains]
-    buses = [{**s, "service_type": "bus"} for s in raw_buses]
-    all_services = trains + buses
+    # Tag services by type without copying them; detailed boards carry large calling point lists
+    all_services = [("train", s) for s in raw_trains] + [("bus", s) for s in raw_buses]
 
     if not all_services:
         return f"No direct services found from {origin} to {destination} at this time."
 
     # Sort chronologically by std
-    all_services.sort(key=lambda s: s.get("std", ""))
+    all_services.sort(key=lambda item: item[1].get("std", ""))
 
-    has_trains = len(trains) > 0
-    has_buses = len(buses) > 0
+    has_trains = len(raw_trains) > 0
+    has_buses = len(raw_buses) > 0
 
     if has_trains and has_buses:
-        title = f"Services from {origin} to {destination}:\n"
+        title = f"Services from {origin} to {destination}:"
     elif has_buses:
-        title = f"🚌 Replacement Buses from {origin} to {destination}:\n"
+        title = f"🚌 Replacement Buses from {origin} to {destination}:"
     else:
-        title = f"🚆 Trains from {origin} to {destination}:\n"
-
-    schedule_lines = [title]
-    for service in all_services[:10]:
-        std = service.get("std")
-        etd = service.get("etd")
-        platform = service.get("platform", "TBA")
-        operator = service.get("operator")
-        is_cancelled = service.get("isCancelled", False)
-        service_type = service.get("service_type")
-
-        emoji = "🚌" if service_type == "bus" else "🚆"
-
-        status = f"{std} -> {etd}"
-        if etd and etd.lower() != 'on time':
-            status = f"{std} (exp. {etd})"
-        if is_cancelled:
-            status = f"{std} - CANCELLED"
-
-        schedule_lines.append(
-            f"{emoji} {status}, Plat: {platform}, Op: {operator}"
-        )
+        title = f"🚆 Trains from {origin} to {destination}:"
+
+    body = "\n".join(_format_service(service_type, service) for service_type, service in all_services[:10])
+    schedule = f"{title}\n\n{body}"
+    if "stale_as_of" in data:
+        schedule = f"⚠️ Live data is unavailable, showing the schedule as of {data['stale_as_of']:%H:%M}.\n\n{schedule}"
 
     # Format NRCC notices/engineering work details
     nrcc_messages = data.get("nrccMessages") or []
@@ -97,8 +194,13 @@ async def fetch_train_schedule(api_token: str, user_agent_str: str, origin: str,
                 notices.append(text)
 
     if notices:
-        schedule_lines.append("\n⚠️ Service Notices:")
-        for notice in notices:
-            schedule_lines.append(f"• {notice}")
+        schedule += "\n\n⚠️ Service Notices:\n" + "\n".join(f"• {notice}" for notice in notices)
+
+    return schedule
+
 
-    return "\n".join(schedule_lines)
+async def fetch_many(api_token: str, user_agent_str: str, routes: List[Tuple[str, str]]) -> List[str]:
+    """Fetches formatted schedules for several (origin, destination) routes concurrently, in order."""
+    return await asyncio.gather(
+        *(fetch_train_schedule(api_token, user_agent_str, origin, destination) for origin, destination in routes)
+    )
@@ -1,14 +1,16 @@
 import os
+import re
 import logging
 import asyncio
 import sqlite3
-import json
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
+from typing import Dict, Optional, Set, Tuple
 from dotenv import load_dotenv
 import telegram
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from national_rail_api import fetch_train_schedule
+from national_rail_api import fetch_train_schedule, close_client
 
 # --- Setup ---
 load_dotenv() # Load environment variables at the very beginning
@@ -22,6 +24,62 @@ NATIONAL_RAIL_API_TOKEN = os.getenv('NATIONAL_RAIL_API_TOKEN')
 USER_AGENT = os.getenv("USER_AGENT", "train-bot-scheduler/0.0.1") # Default user agent for scheduler
 
 RESYNC_INTERVAL_MINUTES = 5 # How often the scheduler re-reads the database for schedule changes
+SLOT_CHANGE_GRACE_SECONDS = 60 # Overlap between incremental resyncs, covering the bot's commit delay
+MAX_CONCURRENT_NOTIFICATIONS = 25 # Most notification sends in flight at once, shared by overlapping dispatches
+DISPATCH_MAX_INSTANCES = 5 # A slow minute's dispatch must not stop the next minutes' from starting
+# Still send a minute's notifications if its dispatch starts late. Must stay under 60s, as the
+# dispatcher takes the minute from the clock when it runs.
+DISPATCH_MISFIRE_GRACE_SECONDS = 30
+
+DB_PATH = 'bot_data.db'
+
+# Shared read connection to the bot's database, opened on first use and reused by every resync
+_conn: Optional[sqlite3.Connection] = None
+
+# 'HH:MM AM/PM' slot times as stored by the bot; parsed by hand as strptime is slow in the resync loop
+_TIME_RE = re.compile(r'^(\d{1,2}):(\d{2})\s*([AaPp])[Mm]?$')
+
+# Unix time the last resync started; None until all schedules have been loaded once
+_last_resync_ts: Optional[float] = None
+
+# PRAGMA data_version seen by the last resync; it changes whenever another connection commits to the database
+_last_data_version: Optional[int] = None
+
+MINUTES_PER_DAY = 24 * 60
+NOTIFICATION_OFFSETS_MINUTES = (0, 30) # Each slot notifies at its time and again 30 minutes later
+
+# In-memory minute index of scheduled notifications, kept up to date by the resync:
+# (user_id, slot_type) -> (origin_crs, dest_crs, minutes of the day), and minute of the day -> slot keys.
+# Entries hold no chat_id or bot; both are supplied when the dispatcher sends.
+_slots: Dict[Tuple[int, str], Tuple[str, str, Tuple[int, ...]]] = {}
+_due: Dict[int, Set[Tuple[int, str]]] = {}
+
+# Caps in-flight sends across every dispatch run; created on first use, inside the running event loop
+_send_semaphore: Optional[asyncio.Semaphore] = None
+
+
+# Users with a commute and at least one slot, read from the generated columns on user_data
+_SCHEDULED_USERS_SQL = """
+    SELECT user_id, home_crs, office_crs, to_slot, from_slot
+    FROM user_data
+    WHERE home_crs IS NOT NULL
+      AND office_crs IS NOT NULL
+      AND (to_slot IS NOT NULL OR from_slot IS NOT NULL)
+"""
+
+# The same query against a user_data table the bot hasn't migrated yet
+_SCHEDULED_USERS_JSON_SQL = """
+    SELECT user_id,
+           json_extract(data, '$.home_crs'),
+           json_extract(data, '$.office_crs'),
+           json_extract(data, '$.to_slot'),
+           json_extract(data, '$.from_slot')
+    FROM user_data
+    WHERE json_valid(data)
+      AND json_extract(data, '$.home_crs') IS NOT NULL
+      AND json_extract(data, '$.office_crs') IS NOT NULL
+      AND (json_extract(data, '$.to_slot') IS NOT NULL OR json_extract(data, '$.from_slot') IS NOT NULL)
+"""
 
 
 async def send_schedule_notification(bot: telegram.Bot, chat_id: int, origin_crs: str, destination_crs: str):
@@ -40,96 +98,227 @@ async def send_schedule_notification(bot: telegram.Bot, chat_id: int, origin_crs
         await bot.send_message(chat_id=chat_id, text=f"Error fetching schedule: {e}")
 
 
-async def get_all_user_data() -> list:
-    """Connects to the SQLite DB and fetches all user data asynchronously."""
-    db_path = 'bot_data.db'
+def _get_connection() -> sqlite3.Connection:
+    """Returns the shared database connection, opening it on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA busy_timeout=60000")
+        _conn.execute("PRAGMA cache_size=-16384") # 16 MB page cache
+    return _conn
+
+
+def close_connection():
+    """Closes the shared database connection, if it is open."""
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+
+async def get_all_user_data() -> Optional[list]:
+    """
+    Connects to the SQLite DB and fetches the schedule settings of users with something to schedule.
+    Returns (user_id, home_crs, office_crs, to_slot, from_slot) rows, read from the generated
+    columns that SQLitePersistence maintains and covered by its partial idx_user_schedules index,
+    or None on a database error.
+    The bot adds those columns when it starts, so until then the JSON is read directly.
+    """
     def sync_get_data():
+        conn = _get_connection()
         try:
-            with sqlite3.connect(db_path) as conn:
-                cursor = conn.execute("SELECT user_id, data FROM user_data")
-                return cursor.fetchall()
+            try:
+                return conn.execute(_SCHEDULED_USERS_SQL).fetchall()
+            except sqlite3.OperationalError as e:
+                if "no such column" not in str(e):
+                    raise
+                logger.warning("user_data has no generated columns yet; reading the JSON directly.")
+                return conn.execute(_SCHEDULED_USERS_JSON_SQL).fetchall()
         except sqlite3.Error as e:
             logger.error(f"Database error while fetching user data: {e}")
-            return []
+            return None
     
     return await asyncio.to_thread(sync_get_data)
 
 
-async def resync_all_user_schedules(bot: telegram.Bot, scheduler: AsyncIOScheduler):
+async def get_changed_slots(since: float) -> Optional[list]:
     """
-    Fetches all user data from the database and updates/adds schedules to the APScheduler.
-    Uses replace_existing=True to handle updates to user schedules.
+    Fetches the schedule slots written after `since` (a Unix timestamp) from the indexed schedule_slots table.
+    Returns (user_id, slot_type, origin_crs, dest_crs, hour, minute, deleted) rows, or None on a database error.
     """
-    logger.info("Resyncing all user schedules from the database...")
-    users = await get_all_user_data()
-    if not users:
-        logger.info("No users found in the database during resync.")
-        # Optionally, remove all existing jobs if no users are found
-        # for job in scheduler.get_jobs():
-        #     if job.id.startswith("user_"): # Assuming user jobs start with "user_"
-        #         scheduler.remove_job(job.id)
+    def sync_get_changes():
+        try:
+            cursor = _get_connection().execute(
+                "SELECT user_id, slot_type, origin_crs, dest_crs, hour, minute, deleted "
+                "FROM schedule_slots WHERE updated_at > ?",
+                (since,)
+            )
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Database error while fetching schedule changes: {e}")
+            return None
+
+    return await asyncio.to_thread(sync_get_changes)
+
+
+async def get_data_version() -> Optional[int]:
+    """Returns the shared connection's PRAGMA data_version, or None on a database error."""
+    def sync_get_version():
+        try:
+            return _get_connection().execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Database error while reading the data version: {e}")
+            return None
+
+    return await asyncio.to_thread(sync_get_version)
+
+
+def _parse_slot(slot_time_str: str) -> Tuple[int, int]:
+    """Parses an 'HH:MM AM/PM' slot into a 24-hour (hour, minute) pair. Raises ValueError if it's malformed."""
+    match = _TIME_RE.match(slot_time_str)
+    if not match:
+        raise ValueError(f"Invalid slot time: {slot_time_str!r}")
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if not 1 <= hour <= 12 or minute > 59:
+        raise ValueError(f"Invalid slot time: {slot_time_str!r}")
+    return hour % 12 + (12 if match.group(3) in 'Pp' else 0), minute
+
+
+def slot_minutes(hour: int, minute: int) -> Tuple[int, ...]:
+    """Returns the minutes of the day at which a slot starting at hour:minute sends its notifications."""
+    start = hour * 60 + minute
+    return tuple((start + offset) % MINUTES_PER_DAY for offset in NOTIFICATION_OFFSETS_MINUTES)
+
+
+def set_slot(user_id: int, slot_type: str, origin_crs: str, dest_crs: str, hour: int, minute: int):
+    """Adds or replaces a slot's notifications in the minute index."""
+    remove_slot(user_id, slot_type)
+    minutes = slot_minutes(hour, minute)
+    _slots[(user_id, slot_type)] = (origin_crs, dest_crs, minutes)
+    for minute_of_day in minutes:
+        _due.setdefault(minute_of_day, set()).add((user_id, slot_type))
+    times = " and ".join(f"{m // 60:02d}:{m % 60:02d}" for m in minutes)
+    logger.info(f"Scheduling '{slot_type}' for user {user_id} at {times} (weekdays).")
+
+
+def remove_slot(user_id: int, slot_type: str):
+    """Removes a slot's notifications from the minute index, if it has any."""
+    entry = _slots.pop((user_id, slot_type), None)
+    if entry is None:
         return
+    for minute_of_day in entry[2]:
+        keys = _due[minute_of_day]
+        keys.discard((user_id, slot_type))
+        if not keys:
+            del _due[minute_of_day]
+    logger.info(f"Removed '{slot_type}' notifications for user {user_id}.")
+
+
+def due_notifications(minute_of_day: int) -> list:
+    """Returns the (chat_id, origin_crs, dest_crs) notifications due at a minute of the day."""
+    # chat_id is the same as user_id for direct messages
+    return [(user_id, *_slots[user_id, slot_type][:2]) for user_id, slot_type in _due.get(minute_of_day, ())]
+
 
-    current_job_ids = set() # To keep track of jobs we've just scheduled
+def _get_send_semaphore() -> asyncio.Semaphore:
+    """Returns the semaphore shared by all dispatch runs, creating it on first use."""
+    global _send_semaphore
+    if _send_semaphore is None:
+        _send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_NOTIFICATIONS)
+    return _send_semaphore
 
-    for user_id, data_json in users:
+
+async def dispatch_notifications(bot: telegram.Bot, minute_of_day: Optional[int] = None):
+    """
+    Runs every weekday minute and sends the notifications due in it, a bounded number at a time.
+    `minute_of_day` defaults to the current minute.
+    """
+    if minute_of_day is None:
+        now = datetime.now()
+        minute_of_day = now.hour * 60 + now.minute
+    due = due_notifications(minute_of_day)
+    if not due:
+        return
+    logger.info(f"Dispatching {len(due)} notification(s) for {minute_of_day // 60:02d}:{minute_of_day % 60:02d}.")
+    semaphore = _get_send_semaphore()
+
+    async def send_one(chat_id: int, origin_crs: str, dest_crs: str):
+        async with semaphore:
+            await send_schedule_notification(bot, chat_id, origin_crs, dest_crs)
+
+    results = await asyncio.gather(*(send_one(*notification) for notification in due), return_exceptions=True)
+    for (chat_id, origin_crs, dest_crs), result in zip(due, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send notification to chat_id {chat_id} ({origin_crs} -> {dest_crs}): {result}")
+
+
+async def resync_all_user_schedules():
+    """
+    Updates the notification minute index from the database.
+    The first call loads every user's schedule; later calls only apply the slots
+    changed since the previous resync, read from the schedule_slots table.
+    Nothing is read when no other connection has committed since the previous resync.
+    """
+    global _last_resync_ts, _last_data_version
+    started_at = time.time()
+
+    # Read before the changes, so a commit landing in between is picked up by the next resync
+    data_version = await get_data_version()
+    if _last_resync_ts is not None and data_version is not None and data_version == _last_data_version:
+        logger.debug("No database changes since the last resync.")
+        return
+
+    if _last_resync_ts is None:
+        if not await load_all_user_schedules():
+            return # Retry the full load on the next resync
+    else:
+        # Re-read a grace window, as the bot may commit a row some time after stamping it
+        changes = await get_changed_slots(_last_resync_ts - SLOT_CHANGE_GRACE_SECONDS)
+        if changes is None:
+            return # Retry the same window on the next resync
+        logger.info(f"Applying {len(changes)} schedule slot change(s) from the database...")
+        for user_id, slot_type, origin_crs, dest_crs, hour, minute, deleted in changes:
+            try:
+                if deleted:
+                    remove_slot(user_id, slot_type)
+                else:
+                    set_slot(user_id, slot_type, origin_crs, dest_crs, hour, minute)
+            except Exception as e:
+                logger.error(f"An unexpected error occurred while scheduling for user {user_id}: {e}. Skipping.")
+
+    _last_resync_ts = started_at
+    _last_data_version = data_version
+
+
+async def load_all_user_schedules() -> bool:
+    """
+    Fetches all user data from the database and rebuilds the notification minute index from it.
+    Slots no longer in the database are dropped along with the old index.
+    Returns False, leaving the index untouched, if the database couldn't be read.
+    """
+    logger.info("Loading all user schedules from the database...")
+    users = await get_all_user_data()
+    if users is None:
+        return False
+
+    _slots.clear()
+    _due.clear()
+    if not users:
+        logger.info("No users with schedules found in the database during resync.")
+
+    for user_id, home_crs, office_crs, to_slot, from_slot in users:
         try:
-            user_data = json.loads(data_json)
-            logger.info(f"Processing user {user_id} with data: {user_data}")
-            home_crs = user_data.get('home_crs')
-            office_crs = user_data.get('office_crs')
-
-            if not home_crs or not office_crs:
-                logger.info(f"Skipping scheduling for user {user_id}: home or office CRS not set.")
-                continue
-            
-            chat_id = user_id # Assuming chat_id is the same as user_id for direct messages
-
-            for slot_type, origin_crs, dest_crs in [('to_slot', home_crs, office_crs), ('from_slot', office_crs, home_crs)]:
-                slot_time_str = user_data.get(slot_type)
+            logger.info(f"Processing user {user_id}: {home_crs} <-> {office_crs}, to_slot={to_slot}, from_slot={from_slot}")
+
+            for slot_type, slot_time_str, origin_crs, dest_crs in [('to_slot', to_slot, home_crs, office_crs), ('from_slot', from_slot, office_crs, home_crs)]:
                 if slot_time_str:
-                    slot_time = datetime.strptime(slot_time_str, "%I:%M %p").time()
-
-                    job_id_1 = f"{user_id}_{slot_type}_1"
-                    scheduler.add_job(
-                        send_schedule_notification,
-                        'cron',
-                        day_of_week='mon-fri', # Schedule only on weekdays
-                        hour=slot_time.hour,
-                        minute=slot_time.minute,
-                        args=[bot, chat_id, origin_crs, dest_crs],
-                        id=job_id_1,
-                        replace_existing=True # Crucial for updating schedules
-                    )
-                    current_job_ids.add(job_id_1)
-
-                    second_notification_dt = (datetime.combine(datetime.today(), slot_time) + timedelta(minutes=30))
-                    second_notification_time = second_notification_dt.time()
-                    
-                    job_id_2 = f"{user_id}_{slot_type}_2"
-                    scheduler.add_job(
-                        send_schedule_notification,
-                        'cron',
-                        day_of_week='mon-fri', # Schedule only on weekdays
-                        hour=second_notification_time.hour,
-                        minute=second_notification_time.minute,
-                        args=[bot, chat_id, origin_crs, dest_crs],
-                        id=job_id_2,
-                        replace_existing=True # Crucial for updating schedules
-                    )
-                    current_job_ids.add(job_id_2)
-                    logger.info(f"Scheduled '{slot_type}' for user {user_id} (chat {chat_id}) at {slot_time.strftime('%H:%M')} and {second_notification_time.strftime('%H:%M')} (weekdays).")
-
-        except json.JSONDecodeError:
-            logger.error(f"Could not parse user_data JSON for user_id {user_id}. Skipping.")
+                    hour, minute = _parse_slot(slot_time_str)
+                    set_slot(user_id, slot_type, origin_crs, dest_crs, hour, minute)
+
         except Exception as e:
             logger.error(f"An unexpected error occurred while scheduling for user {user_id}: {e}. Skipping.")
 
-    # Remove any jobs that are no longer in the database (e.g., user deleted schedule)
-    for job in scheduler.get_jobs():
-        if job.id.startswith(f"{user_id}_") and job.id not in current_job_ids:
-            scheduler.remove_job(job.id)
-            logger.info(f"Removed stale job: {job.id}")
+    return True
 
 
 async def main():
@@ -147,19 +336,31 @@ async def main():
     logger.info(f"Scheduler starting with timezone: {scheduler.timezone}")
 
     # Initial load of all schedules
-    await resync_all_user_schedules(bot, scheduler)
+    await resync_all_user_schedules()
 
     # Schedule periodic re-sync
     scheduler.add_job(
         resync_all_user_schedules,
         'interval',
         minutes=RESYNC_INTERVAL_MINUTES,
-        args=[bot, scheduler],
         id='resync_job',
         replace_existing=True
     )
     logger.info(f"Scheduled periodic resync every {RESYNC_INTERVAL_MINUTES} minutes.")
 
+    # One job sends every user's notifications, rather than a cron job per user and slot
+    scheduler.add_job(
+        dispatch_notifications,
+        'cron',
+        day_of_week='mon-fri', # Notify only on weekdays
+        minute='*',
+        args=[bot],
+        id='dispatch_job',
+        max_instances=DISPATCH_MAX_INSTANCES,
+        misfire_grace_time=DISPATCH_MISFIRE_GRACE_SECONDS,
+        replace_existing=True
+    )
+
 
     scheduler.start()
     logger.info("Scheduler started. Press Ctrl+C to exit.")
@@ -168,8 +369,11 @@ async def main():
     try:
         while True:
             await asyncio.sleep(3600)  # Sleep for an hour, the scheduler runs in the background
-    except (KeyboardInterrupt, SystemExit):
+    finally:
+        # Ctrl+C under asyncio.run() arrives as a cancellation, so clean up on any exit
         scheduler.shutdown()
+        await close_client()
+        close_connection()
         logger.info("Scheduler shut down.")
 
 
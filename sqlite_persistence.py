@@ -1,11 +1,37 @@
 import sqlite3
-import json
 import logging
 import asyncio
-from typing import Dict, Any, Optional, Tuple
+import time
+from contextlib import suppress
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
 
 from telegram.ext import BasePersistence
 
+try:
+    import orjson
+
+    def _json_dumps(data: Any) -> str:
+        # json.dumps turns non-string keys into strings; orjson needs to be told to do the same
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson has no wheel for this platform; fall back to the stdlib
+    import json
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# Bumped whenever _migrate learns a new step; stored in the database as PRAGMA user_version.
+SCHEMA_VERSION = 3
+
+# Fields of the user_data JSON exposed as indexed generated columns, so the scheduler can filter on them cheaply.
+USER_DATA_COLUMNS = ("home_crs", "office_crs", "to_slot", "from_slot")
+
+
+def _user_data_column(name: str) -> str:
+    """Column definition for a generated user_data column; rows with malformed JSON yield NULL."""
+    return f"{name} TEXT GENERATED ALWAYS AS (CASE WHEN json_valid(data) THEN json_extract(data, '$.{name}') END) VIRTUAL"
+
 
 class SQLitePersistence(BasePersistence):
     """
@@ -13,10 +39,14 @@ class SQLitePersistence(BasePersistence):
     This implementation is fully asynchronous to work with PTB's asyncio event loop.
     """
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, flush_interval: float = 2.0):
         super().__init__()
         self.filepath = filepath
         self.conn = None
+        # Writes are committed in batches by a background loop rather than one by one.
+        self.flush_interval = flush_interval
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
         # Note: The connection itself is synchronous, but we'll use asyncio.to_thread for operations.
         self._connect()
         self._create_tables()
@@ -24,17 +54,31 @@ class SQLitePersistence(BasePersistence):
     def _connect(self):
         """Establish connection to the SQLite database."""
         self.conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        # WAL lets the scheduler read while the bot writes; NORMAL sync is safe under WAL.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        self.conn.execute("PRAGMA busy_timeout=60000")  # Wait up to 60s for the scheduler's locks
 
     def _create_tables(self):
         """Create the necessary tables if they don't already exist."""
         # The `with self.conn` here is safe as it's only used for initial setup.
         with self.conn:
-            self.conn.execute('''
+            version = self._migrate()
+            self.conn.execute(f'''
                 CREATE TABLE IF NOT EXISTS user_data (
                     user_id INTEGER PRIMARY KEY,
-                    data TEXT NOT NULL
+                    data TEXT NOT NULL,
+                    {", ".join(_user_data_column(name) for name in USER_DATA_COLUMNS)}
                 )
             ''')
+            # Partial covering index for the scheduler's "users with a commute configured" query
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_user_schedules ON user_data (home_crs, office_crs, to_slot, from_slot)
+                WHERE home_crs IS NOT NULL AND office_crs IS NOT NULL
+            ''')
             self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS chat_data (
                     chat_id INTEGER PRIMARY KEY,
@@ -45,17 +89,80 @@ class SQLitePersistence(BasePersistence):
                 CREATE TABLE IF NOT EXISTS bot_data (
                     key TEXT PRIMARY KEY,
                     data TEXT NOT NULL
-                )
+                ) WITHOUT ROWID
             ''')
             self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS callback_data (
                     key TEXT PRIMARY KEY,
                     data TEXT NOT NULL
-                )
+                ) WITHOUT ROWID
+            ''')
+            # Normalized copy of each user's notification slots, so the scheduler can read only what changed.
+            # Removed slots are kept as tombstones (deleted = 1) so their jobs can be unscheduled.
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS schedule_slots (
+                    user_id INTEGER NOT NULL,
+                    slot_type TEXT NOT NULL,
+                    origin_crs TEXT,
+                    dest_crs TEXT,
+                    hour INTEGER,
+                    minute INTEGER,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, slot_type)
+                ) WITHOUT ROWID
             ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_slots_updated ON schedule_slots(updated_at)")
+            if version < 3:
+                # v3: schedule_slots is filled in for users saved before it existed.
+                self._backfill_schedule_slots()
             # Ensure default rows exist
             self.conn.execute("INSERT OR IGNORE INTO bot_data (key, data) VALUES ('bot_data', '{}')")
             self.conn.execute("INSERT OR IGNORE INTO callback_data (key, data) VALUES ('callback_data', '{}')")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate(self) -> int:
+        """
+        Upgrades tables created by older versions of this class. Runs inside `_create_tables`' transaction.
+        Returns the schema version the database had before upgrading.
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # v1: key/value tables become WITHOUT ROWID, so the primary key is the table's only B-tree.
+            for table in ("bot_data", "callback_data"):
+                exists = self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).fetchone()
+                if not exists:
+                    continue
+                logging.info(f"Migrating {table} to a WITHOUT ROWID table.")
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+                self.conn.execute(f"CREATE TABLE {table}_new (key TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID")
+                self.conn.execute(f"INSERT INTO {table}_new (key, data) SELECT key, data FROM {table}")
+                self.conn.execute(f"DROP TABLE {table}")
+                self.conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        if version < 2:
+            # v2: user_data gains generated columns for the fields the scheduler filters on.
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_data'"
+            ).fetchone()
+            if exists:
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_xinfo(user_data)")}
+                for name in USER_DATA_COLUMNS:
+                    if name not in columns:
+                        self.conn.execute(f"ALTER TABLE user_data ADD COLUMN {_user_data_column(name)}")
+        return version
+
+    def _backfill_schedule_slots(self):
+        """Mirrors every stored user's slots into schedule_slots. Runs inside `_create_tables`' transaction."""
+        for user_id, data_json in self.conn.execute("SELECT user_id, data FROM user_data").fetchall():
+            try:
+                data = _json_loads(data_json)
+            except ValueError:
+                logging.warning(f"Skipping malformed user_data for user {user_id} while backfilling schedule slots.")
+                continue
+            if isinstance(data, dict):
+                self._sync_schedule_slots(user_id, data)
 
     async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
         """Returns the user_data from the database."""
@@ -66,7 +173,7 @@ class SQLitePersistence(BasePersistence):
                 
                 data = {}
                 for key, data_json in rows:
-                    data[key] = json.loads(data_json)
+                    data[key] = _json_loads(data_json)
                 return data
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in get_user_data: {e}")
@@ -83,7 +190,7 @@ class SQLitePersistence(BasePersistence):
                 
                 data = {}
                 for key, data_json in rows:
-                    data[key] = json.loads(data_json)
+                    data[key] = _json_loads(data_json)
                 return data
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in get_chat_data: {e}")
@@ -98,7 +205,7 @@ class SQLitePersistence(BasePersistence):
                 cursor = self.conn.execute("SELECT data FROM bot_data WHERE key = 'bot_data'")
                 row = cursor.fetchone()
                 if row:
-                    return json.loads(row[0])
+                    return _json_loads(row[0])
                 return {}
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in get_bot_data: {e}")
@@ -113,7 +220,7 @@ class SQLitePersistence(BasePersistence):
                 cursor = self.conn.execute("SELECT data FROM callback_data WHERE key = 'callback_data'")
                 row = cursor.fetchone()
                 if row:
-                    return json.loads(row[0])
+                    return _json_loads(row[0])
                 return {}
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in get_callback_data: {e}")
@@ -121,49 +228,105 @@ class SQLitePersistence(BasePersistence):
         
         return await asyncio.to_thread(sync_get_callback_data)
 
+    def _sync_schedule_slots(self, user_id: int, data: Dict[Any, Any]) -> None:
+        """
+        Mirrors a user's notification slots into schedule_slots.
+        Rows are only touched when a slot actually changes, so `updated_at` marks real changes.
+        """
+        now = time.time()
+        home_crs = data.get('home_crs')
+        office_crs = data.get('office_crs')
+        for slot_type, origin_crs, dest_crs in (('to_slot', home_crs, office_crs), ('from_slot', office_crs, home_crs)):
+            slot_time = None
+            if origin_crs and dest_crs and data.get(slot_type):
+                try:
+                    slot_time = datetime.strptime(data[slot_type], "%I:%M %p")
+                except ValueError:
+                    logging.warning(f"Ignoring invalid {slot_type} '{data[slot_type]}' for user {user_id}.")
+
+            if slot_time is None:
+                self.conn.execute(
+                    "UPDATE schedule_slots SET deleted = 1, updated_at = ? "
+                    "WHERE user_id = ? AND slot_type = ? AND deleted = 0",
+                    (now, user_id, slot_type)
+                )
+                continue
+
+            self.conn.execute('''
+                INSERT INTO schedule_slots (user_id, slot_type, origin_crs, dest_crs, hour, minute, deleted, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+                ON CONFLICT (user_id, slot_type) DO UPDATE SET
+                    origin_crs = excluded.origin_crs,
+                    dest_crs = excluded.dest_crs,
+                    hour = excluded.hour,
+                    minute = excluded.minute,
+                    deleted = 0,
+                    updated_at = excluded.updated_at
+                WHERE (origin_crs, dest_crs, hour, minute, deleted)
+                    IS NOT (excluded.origin_crs, excluded.dest_crs, excluded.hour, excluded.minute, 0)
+            ''', (user_id, slot_type, origin_crs, dest_crs, slot_time.hour, slot_time.minute, now))
+
     async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
-        """Updates a user's data in the database."""
+        """Updates a user's data (and their schedule slots) in the database."""
         def sync_update_user_data():
-            data_json = json.dumps(data)
+            data_json = _json_dumps(data)
             self.conn.execute(
                 "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
                 (user_id, data_json)
             )
+            self._sync_schedule_slots(user_id, data)
         
         await asyncio.to_thread(sync_update_user_data)
+        self._dirty = True
+
+    async def update_user_data_many(self, items: List[Tuple[int, Dict[Any, Any]]]) -> None:
+        """Updates several users' data (and their schedule slots) in a single committed transaction."""
+        def sync_update_user_data_many():
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                    [(user_id, _json_dumps(data)) for user_id, data in items]
+                )
+                for user_id, data in items:
+                    self._sync_schedule_slots(user_id, data)
+
+        await asyncio.to_thread(sync_update_user_data_many)
 
     async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
         """Updates a chat's data in the database."""
         def sync_update_chat_data():
-            data_json = json.dumps(data)
+            data_json = _json_dumps(data)
             self.conn.execute(
                 "INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
                 (chat_id, data_json)
             )
 
         await asyncio.to_thread(sync_update_chat_data)
+        self._dirty = True
 
     async def update_bot_data(self, data: Dict[Any, Any]) -> None:
         """Updates the bot's data in the database."""
         def sync_update_bot_data():
-            data_json = json.dumps(data)
+            data_json = _json_dumps(data)
             self.conn.execute(
                 "INSERT OR REPLACE INTO bot_data (key, data) VALUES ('bot_data', ?)",
                 (data_json,)
             )
         
         await asyncio.to_thread(sync_update_bot_data)
+        self._dirty = True
 
     async def update_callback_data(self, data: Dict[Any, Any]) -> None:
         """Updates the callback_data in the database."""
         def sync_update_callback_data():
-            data_json = json.dumps(data)
+            data_json = _json_dumps(data)
             self.conn.execute(
                 "INSERT OR REPLACE INTO callback_data (key, data) VALUES ('callback_data', ?)",
                 (data_json,)
             )
 
         await asyncio.to_thread(sync_update_callback_data)
+        self._dirty = True
 
     async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
         """Updates the in-memory user_data dict with data from the database."""
@@ -172,7 +335,7 @@ class SQLitePersistence(BasePersistence):
                 cursor = self.conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
                 row = cursor.fetchone()
                 if row:
-                    return json.loads(row[0])
+                    return _json_loads(row[0])
                 return None
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in refresh_user_data for user {user_id}: {e}")
@@ -189,7 +352,7 @@ class SQLitePersistence(BasePersistence):
                 cursor = self.conn.execute("SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,))
                 row = cursor.fetchone()
                 if row:
-                    return json.loads(row[0])
+                    return _json_loads(row[0])
                 return None
             except sqlite3.Error as e:
                 logging.error(f"SQLite error in refresh_chat_data for chat {chat_id}: {e}")
@@ -209,8 +372,13 @@ class SQLitePersistence(BasePersistence):
         """Deletes a user's data from the database."""
         def sync_drop_user_data():
             self.conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+            self.conn.execute(
+                "UPDATE schedule_slots SET deleted = 1, updated_at = ? WHERE user_id = ? AND deleted = 0",
+                (time.time(), user_id)
+            )
         
         await asyncio.to_thread(sync_drop_user_data)
+        self._dirty = True
 
     async def drop_chat_data(self, chat_id: int) -> None:
         """Deletes a chat's data from the database."""
@@ -218,6 +386,7 @@ class SQLitePersistence(BasePersistence):
             self.conn.execute("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
 
         await asyncio.to_thread(sync_drop_chat_data)
+        self._dirty = True
 
     async def get_conversations(self, name: str) -> Dict:
         return {}
@@ -231,7 +400,35 @@ class SQLitePersistence(BasePersistence):
             if self.conn:
                 self.conn.commit()
         
-        await asyncio.to_thread(sync_flush)
+        self._dirty = False
+        try:
+            await asyncio.to_thread(sync_flush)
+        except sqlite3.Error:
+            self._dirty = True
+            raise
+
+    def start_flush_loop(self) -> None:
+        """Starts committing pending writes every `flush_interval` seconds. Requires a running event loop."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop_flush_loop(self) -> None:
+        """Stops the background flush loop. Pending writes are left for the final `flush`."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+
+    async def _flush_loop(self) -> None:
+        """Commits pending writes periodically so other processes (e.g. the scheduler) can see them."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    await self.flush()
+                except sqlite3.Error as e:
+                    logging.error(f"SQLite error while flushing pending writes: {e}")
 
     def close(self) -> None:
         """Closes the database connection."""
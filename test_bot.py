@@ -1,8 +1,22 @@
-import pytest
-from unittest.mock import AsyncMock, patch
+import asyncio
 import json
-import requests
-from bot import fetch_train_schedule
+import re
+import sqlite3
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+import httpx
+import pytest
+import pytest_asyncio
+import respx
+from telegram.ext import ApplicationHandlerStop
+import national_rail_api
+import scheduler
+from bot import auth_gate, fetch_train_schedule, requires_crs
+from sqlite_persistence import SQLitePersistence
+
+API_TOKEN = "test_api_token"
+USER_AGENT = "test-agent"
+DEPARTURES_URL = re.compile(r"^https://api1\.raildata\.org\.uk/.+/GetDepBoardWithDetails/(?P<origin>[A-Z]{3})")
 
 # Mock the os.getenv call for the API token
 @pytest.fixture(autouse=True)
@@ -10,18 +24,52 @@ def mock_env_vars():
     with patch('os.getenv', return_value='test_api_token'):
         yield
 
-# Helper to create a mock response object
-def create_mock_response(json_data, status_code=200):
-    mock_response = AsyncMock(spec=requests.Response)
-    mock_response.status_code = status_code
-    mock_response.json.return_value = json_data
-    mock_response.raise_for_status.return_value = None
-    # For HTTPError, we need to make sure the response is accessible
-    mock_response.response = mock_response
-    return mock_response
+# Start every test with an empty schedule cache
+@pytest.fixture(autouse=True)
+def clear_schedule_cache():
+    national_rail_api._schedule_cache.clear()
+    national_rail_api._stale_cache.clear()
+    yield
+
+# Close the shared HTTP client after each test, as every test runs in its own event loop
+@pytest_asyncio.fixture(autouse=True)
+async def reset_http_client():
+    yield
+    await national_rail_api.close_client()
+
+# Mock the National Rail departure board endpoint; tests set the response or side effect
+@pytest.fixture
+def departures():
+    with respx.mock(assert_all_called=False) as mock:
+        yield mock.get(url__regex=DEPARTURES_URL)
+
+# Point the scheduler's shared connection at a temporary database
+@pytest.fixture
+def scheduler_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "bot_data.db")
+    monkeypatch.setattr(scheduler, 'DB_PATH', db_path)
+    monkeypatch.setattr(scheduler, '_conn', None)
+    yield db_path
+    scheduler.close_connection()
+
+# Start with an empty notification index that has never been loaded
+@pytest.fixture
+def scheduler_state(monkeypatch):
+    monkeypatch.setattr(scheduler, '_slots', {})
+    monkeypatch.setattr(scheduler, '_due', {})
+    monkeypatch.setattr(scheduler, '_last_resync_ts', None)
+    monkeypatch.setattr(scheduler, '_last_data_version', None)
+    monkeypatch.setattr(scheduler, '_send_semaphore', None)
+
+# The bot's persistence, writing to the scheduler's temporary database
+@pytest.fixture
+def persistence(scheduler_db):
+    persistence = SQLitePersistence(filepath=scheduler_db)
+    yield persistence
+    persistence.close()
 
 @pytest.mark.asyncio
-async def test_fetch_train_schedule_on_time():
+async def test_fetch_train_schedule_on_time(departures):
     mock_api_response = {
         "trainServices": [
             {
@@ -33,15 +81,14 @@ async def test_fetch_train_schedule_on_time():
             }
         ]
     }
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.return_value = create_mock_response(mock_api_response)
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "Trains from MAN to LDS:" in result
-        assert "- 10:00 -> On time, Plat: 1, Op: Northern" in result
-        assert "DELAYED" not in result
+    departures.mock(return_value=httpx.Response(200, json=mock_api_response))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Trains from MAN to LDS:" in result
+    assert "🚆 10:00 -> On time, Plat: 1, Op: Northern" in result
+    assert "DELAYED" not in result
 
 @pytest.mark.asyncio
-async def test_fetch_train_schedule_small_delay():
+async def test_fetch_train_schedule_small_delay(departures):
     mock_api_response = {
         "trainServices": [
             {
@@ -53,15 +100,14 @@ async def test_fetch_train_schedule_small_delay():
             }
         ]
     }
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.return_value = create_mock_response(mock_api_response)
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "Trains from MAN to LDS:" in result
-        assert "- 10:00 (exp. 10:05), Plat: 2, Op: TransPennine Express" in result
-        assert "DELAYED" not in result
+    departures.mock(return_value=httpx.Response(200, json=mock_api_response))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Trains from MAN to LDS:" in result
+    assert "🚆 10:00 (exp. 10:05), Plat: 2, Op: TransPennine Express" in result
+    assert "DELAYED" not in result
 
 @pytest.mark.asyncio
-async def test_fetch_train_schedule_cancelled():
+async def test_fetch_train_schedule_cancelled(departures):
     mock_api_response = {
         "trainServices": [
             {
@@ -73,35 +119,388 @@ async def test_fetch_train_schedule_cancelled():
             }
         ]
     }
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.return_value = create_mock_response(mock_api_response)
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "Trains from MAN to LDS:" in result
-        assert "- 11:00 - CANCELLED, Plat: 4, Op: CrossCountry" in result
-        assert "DELAYED" not in result # Should not show delayed if cancelled
+    departures.mock(return_value=httpx.Response(200, json=mock_api_response))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Trains from MAN to LDS:" in result
+    assert "🚆 11:00 - CANCELLED, Plat: 4, Op: CrossCountry" in result
+    assert "DELAYED" not in result # Should not show delayed if cancelled
 
 @pytest.mark.asyncio
-async def test_fetch_train_schedule_no_services():
+async def test_fetch_train_schedule_no_services(departures):
     mock_api_response = {
         "trainServices": []
     }
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.return_value = create_mock_response(mock_api_response)
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "No direct services found from MAN to LDS at this time." in result
-
-@pytest.mark.asyncio
-async def test_fetch_train_schedule_api_error():
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.side_effect = requests.exceptions.RequestException("Connection error")
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "Sorry, I couldn't connect to the train schedule service." in result
-
-@pytest.mark.asyncio
-async def test_fetch_train_schedule_http_error():
-    mock_response = create_mock_response({}, status_code=403)
-    mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_response)
-    with patch('asyncio.to_thread', new_callable=AsyncMock) as mock_to_thread:
-        mock_to_thread.return_value = mock_response
-        result = await fetch_train_schedule("MAN", "LDS")
-        assert "Sorry, there was a problem reaching the schedule service (HTTP 403)." in result
+    departures.mock(return_value=httpx.Response(200, json=mock_api_response))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "No direct services found from MAN to LDS at this time." in result
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_api_error(departures):
+    departures.mock(side_effect=httpx.ConnectError)
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Sorry, Could not connect to the train schedule service." in result
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_rejects_invalid_station_codes(departures):
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MANC", "LDS")
+    assert result == "Sorry, Invalid station code."
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, None, "LDS")
+    assert result == "Sorry, Invalid station code."
+    assert not departures.called
+
+    departures.mock(return_value=httpx.Response(200, json={"trainServices": []}))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "man", "lds")
+    assert "No direct services found from MAN to LDS at this time." in result
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_http_error(departures):
+    departures.mock(return_value=httpx.Response(403, json={}))
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Sorry, Problem reaching the schedule service (HTTP 403)." in result
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_uses_cache(departures):
+    departures.mock(return_value=httpx.Response(200, json={"trainServices": [{"std": "10:00", "etd": "On time", "platform": "1", "operator": "Northern"}]}))
+    first = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    second = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert first == second
+    assert departures.call_count == 1
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_coalesces_concurrent_requests(departures):
+    departures.mock(return_value=httpx.Response(200, json={"trainServices": []}))
+    results = await asyncio.gather(
+        fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS"),
+        fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS"),
+    )
+    assert results[0] == results[1]
+    assert departures.call_count == 1
+
+@pytest.mark.asyncio
+async def test_persistence_flush_loop_commits_pending_writes(tmp_path):
+    db_path = tmp_path / "bot_data.db"
+    persistence = SQLitePersistence(filepath=str(db_path), flush_interval=0.01)
+    persistence.start_flush_loop()
+    try:
+        await persistence.update_user_data(42, {"home_crs": "MAN"})
+        await asyncio.sleep(0.1)
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("SELECT user_id FROM user_data").fetchall()
+        assert rows == [(42,)]
+    finally:
+        await persistence.stop_flush_loop()
+        persistence.close()
+
+@pytest.mark.asyncio
+async def test_requires_crs_rejects_unconfigured_user():
+    handler = AsyncMock()
+    update = MagicMock()
+    update.message.reply_text = AsyncMock()
+    context = MagicMock(user_data={'home_crs': 'MAN'})
+
+    await requires_crs(handler)(update, context)
+    handler.assert_not_awaited()
+    update.message.reply_text.assert_awaited_once()
+
+    context.user_data['office_crs'] = 'LDS'
+    await requires_crs(handler)(update, context)
+    handler.assert_awaited_once_with(update, context, 'MAN', 'LDS')
+
+@pytest.mark.asyncio
+async def test_fetch_train_schedule_falls_back_to_stale_data(departures):
+    mock_api_response = {
+        "trainServices": [
+            {"std": "10:00", "etd": "On time", "platform": "1", "operator": "Northern"}
+        ]
+    }
+    departures.mock(return_value=httpx.Response(200, json=mock_api_response))
+    await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+
+    national_rail_api._schedule_cache.clear()
+
+    departures.mock(side_effect=httpx.ConnectError)
+    result = await fetch_train_schedule(API_TOKEN, USER_AGENT, "MAN", "LDS")
+    assert "Live data is unavailable" in result
+    assert "🚆 10:00 -> On time, Plat: 1, Op: Northern" in result
+
+@pytest.mark.asyncio
+async def test_fetch_many_returns_schedules_in_order(departures):
+    def board(request, origin):
+        return httpx.Response(200, json={"trainServices": [{"std": "10:00", "etd": "On time", "platform": "1", "operator": origin}]})
+
+    departures.mock(side_effect=board)
+    results = await national_rail_api.fetch_many(API_TOKEN, USER_AGENT, [("MAN", "LDS"), ("LDS", "MAN")])
+    assert "Trains from MAN to LDS:" in results[0]
+    assert "Trains from LDS to MAN:" in results[1]
+
+@pytest.mark.asyncio
+async def test_auth_gate_stops_unauthorized_users():
+    update = MagicMock(callback_query=None)
+    update.effective_user.id = 1
+    update.message.text = "/start"
+    update.message.reply_text = AsyncMock()
+
+    with patch('bot.AUTHORIZED_USER_IDS', frozenset({2})):
+        with pytest.raises(ApplicationHandlerStop):
+            await auth_gate(update, MagicMock())
+        assert "`1`" in update.message.reply_text.await_args.args[0]
+
+        update.effective_user.id = 2
+        await auth_gate(update, MagicMock())
+
+@pytest.mark.asyncio
+async def test_scheduled_notifications_share_one_request_per_route(departures):
+    departures.mock(return_value=httpx.Response(200, json={"trainServices": [{"std": "08:00", "etd": "On time", "platform": "1", "operator": "Northern"}]}))
+
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+    with patch.object(scheduler, 'NATIONAL_RAIL_API_TOKEN', API_TOKEN):
+        await asyncio.gather(
+            scheduler.send_schedule_notification(bot, 1, "MAN", "LDS"),
+            scheduler.send_schedule_notification(bot, 2, "MAN", "LDS"),
+        )
+        await scheduler.send_schedule_notification(bot, 3, "MAN", "LDS")
+
+    assert departures.call_count == 1
+    assert bot.send_message.await_count == 3
+
+def test_persistence_migrates_key_value_tables_to_without_rowid(tmp_path):
+    db_path = tmp_path / "bot_data.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE bot_data (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute("INSERT INTO bot_data (key, data) VALUES ('bot_data', '{\"a\": 1}')")
+    conn.close()
+
+    persistence = SQLitePersistence(filepath=str(db_path))
+    try:
+        for table in ("bot_data", "callback_data"):
+            sql = persistence.conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+            assert "WITHOUT ROWID" in sql
+        assert persistence.conn.execute("SELECT data FROM bot_data").fetchone() == ('{"a": 1}',)
+    finally:
+        persistence.close()
+
+@pytest.mark.asyncio
+async def test_get_all_user_data_returns_only_scheduled_users(persistence):
+    with persistence.conn:
+        persistence.conn.executemany("INSERT INTO user_data (user_id, data) VALUES (?, ?)", [
+            (1, json.dumps({"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})),
+            (2, json.dumps({"home_crs": "MAN", "office_crs": "LDS"})),
+            (3, json.dumps({"home_crs": "MAN", "from_slot": "05:30 PM"})),
+            (4, "not json"),
+        ])
+
+    assert await scheduler.get_all_user_data() == [(1, "MAN", "LDS", "08:30 AM", None)]
+
+@pytest.mark.asyncio
+async def test_get_all_user_data_reads_unmigrated_user_data(scheduler_db):
+    with sqlite3.connect(scheduler_db) as conn:
+        conn.execute("CREATE TABLE user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.executemany("INSERT INTO user_data (user_id, data) VALUES (?, ?)", [
+            (1, json.dumps({"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})),
+            (2, "not json"),
+        ])
+    conn.close()
+
+    assert await scheduler.get_all_user_data() == [(1, "MAN", "LDS", "08:30 AM", None)]
+
+@pytest.mark.asyncio
+async def test_persistence_tracks_schedule_slot_changes(tmp_path):
+    persistence = SQLitePersistence(filepath=str(tmp_path / "bot_data.db"))
+    query = "SELECT slot_type, origin_crs, dest_crs, hour, minute, deleted, updated_at FROM schedule_slots"
+    try:
+        user = {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"}
+        await persistence.update_user_data(1, user)
+        [row] = persistence.conn.execute(query).fetchall()
+        assert row[:6] == ("to_slot", "MAN", "LDS", 8, 30, 0)
+
+        # Unchanged slots keep their timestamp
+        await persistence.update_user_data(1, {**user, "unrelated": True})
+        assert persistence.conn.execute(query).fetchall() == [row]
+
+        await persistence.update_user_data(1, {"home_crs": "MAN", "office_crs": "LDS"})
+        [deleted] = persistence.conn.execute(query).fetchall()
+        assert deleted[5] == 1 and deleted[6] > row[6]
+    finally:
+        persistence.close()
+
+@pytest.mark.asyncio
+async def test_resync_applies_only_changed_slots(persistence, scheduler_state):
+    await scheduler.resync_all_user_schedules()
+    assert scheduler.due_notifications(8 * 60 + 30) == []
+
+    await persistence.update_user_data(1, {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})
+    await persistence.flush()
+    await scheduler.resync_all_user_schedules()
+    assert scheduler.due_notifications(8 * 60 + 30) == [(1, "MAN", "LDS")]
+    assert scheduler.due_notifications(9 * 60) == [(1, "MAN", "LDS")]
+
+    await persistence.update_user_data(1, {"home_crs": "MAN", "office_crs": "LDS"})
+    await persistence.flush()
+    await scheduler.resync_all_user_schedules()
+    assert scheduler._due == {}
+
+@pytest.mark.asyncio
+async def test_full_load_drops_slots_missing_from_database(persistence, scheduler_state):
+    scheduler.set_slot(1, "to_slot", "MAN", "LDS", 8, 0)
+    scheduler.set_slot(2, "from_slot", "LDS", "MAN", 17, 0)
+    await persistence.update_user_data(3, {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:00 AM"})
+    await persistence.flush()
+
+    await scheduler.resync_all_user_schedules()
+    assert set(scheduler._slots) == {(3, "to_slot")}
+    assert scheduler.due_notifications(8 * 60) == [(3, "MAN", "LDS")]
+    assert scheduler.due_notifications(17 * 60) == []
+
+    # A database without any scheduled users clears the index too
+    await persistence.drop_user_data(3)
+    await persistence.flush()
+    scheduler._last_resync_ts = None
+    await scheduler.resync_all_user_schedules()
+    assert scheduler._slots == {} and scheduler._due == {}
+
+@pytest.mark.asyncio
+async def test_full_load_is_retried_after_a_database_error(scheduler_db, scheduler_state):
+    # The scheduler can start before the bot has created any tables
+    await scheduler.resync_all_user_schedules()
+    assert scheduler._last_resync_ts is None
+
+    persistence = SQLitePersistence(filepath=scheduler_db)
+    try:
+        await persistence.update_user_data(1, {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})
+        await persistence.flush()
+    finally:
+        persistence.close()
+
+    await scheduler.resync_all_user_schedules()
+    assert scheduler.due_notifications(8 * 60 + 30) == [(1, "MAN", "LDS")]
+
+@pytest.mark.asyncio
+async def test_persistence_backfills_schedule_slots_for_existing_users(tmp_path):
+    db_path = tmp_path / "bot_data.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.executemany("INSERT INTO user_data (user_id, data) VALUES (?, ?)", [
+            (1, json.dumps({"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})),
+            (2, "not json"),
+        ])
+    conn.close()
+
+    persistence = SQLitePersistence(filepath=str(db_path))
+    query = "SELECT user_id, slot_type, hour, minute, deleted FROM schedule_slots"
+    try:
+        assert persistence.conn.execute(query).fetchall() == [(1, "to_slot", 8, 30, 0)]
+
+        await persistence.drop_user_data(1)
+        assert persistence.conn.execute(query).fetchall() == [(1, "to_slot", 8, 30, 1)]
+    finally:
+        persistence.close()
+
+@pytest.mark.asyncio
+async def test_resync_skips_unchanged_database(persistence, scheduler_state, monkeypatch):
+    await scheduler.resync_all_user_schedules()
+
+    get_changed_slots = AsyncMock(wraps=scheduler.get_changed_slots)
+    monkeypatch.setattr(scheduler, 'get_changed_slots', get_changed_slots)
+    await scheduler.resync_all_user_schedules()
+    get_changed_slots.assert_not_awaited()
+
+    await persistence.update_user_data(1, {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"})
+    await persistence.flush()
+    await scheduler.resync_all_user_schedules()
+    get_changed_slots.assert_awaited_once()
+    assert scheduler.due_notifications(8 * 60 + 30) == [(1, "MAN", "LDS")]
+
+@pytest.mark.asyncio
+async def test_dispatch_sends_notifications_due_this_minute(scheduler_state):
+    scheduler.set_slot(1, "to_slot", "MAN", "LDS", 8, 0)
+    scheduler.set_slot(2, "to_slot", "LDS", "MAN", 8, 15)
+
+    send = AsyncMock()
+    with patch.object(scheduler, 'send_schedule_notification', send):
+        await scheduler.dispatch_notifications(MagicMock(), 8 * 60 + 30)
+    send.assert_awaited_once()
+    assert send.await_args.args[1:] == (1, "MAN", "LDS")
+
+@pytest.mark.asyncio
+async def test_dispatch_logs_failed_notifications(scheduler_state, caplog):
+    scheduler.set_slot(1, "to_slot", "MAN", "LDS", 8, 0)
+    scheduler.set_slot(2, "to_slot", "LDS", "MAN", 8, 0)
+
+    async def send(bot, chat_id, origin_crs, dest_crs):
+        if chat_id == 1:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+
+    with patch.object(scheduler, 'send_schedule_notification', send):
+        await scheduler.dispatch_notifications(MagicMock(), 8 * 60)
+    errors = [record.getMessage() for record in caplog.records if record.levelname == "ERROR"]
+    assert errors == ["Failed to send notification to chat_id 1 (MAN -> LDS): Forbidden: bot was blocked by the user"]
+
+@pytest.mark.asyncio
+async def test_dispatch_bounds_concurrent_notifications(scheduler_state, monkeypatch):
+    monkeypatch.setattr(scheduler, 'MAX_CONCURRENT_NOTIFICATIONS', 2)
+    for user_id in range(5):
+        scheduler.set_slot(user_id, "to_slot", "MAN", "LDS", 8, 0)
+
+    active = peak = 0
+    async def send(bot, chat_id, origin_crs, dest_crs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0)
+        active -= 1
+
+    with patch.object(scheduler, 'send_schedule_notification', send):
+        await scheduler.dispatch_notifications(MagicMock(), 8 * 60)
+    assert peak == 2
+
+@pytest.mark.asyncio
+async def test_overlapping_dispatches_share_the_concurrency_cap(scheduler_state, monkeypatch):
+    monkeypatch.setattr(scheduler, 'MAX_CONCURRENT_NOTIFICATIONS', 3)
+    for user_id in range(5):
+        scheduler.set_slot(user_id, "to_slot", "MAN", "LDS", 8, 0)
+        scheduler.set_slot(user_id, "from_slot", "LDS", "MAN", 8, 1)
+
+    active = peak = 0
+    async def send(bot, chat_id, origin_crs, dest_crs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    # A slow minute's dispatch is still running when the next minute's starts
+    with patch.object(scheduler, 'send_schedule_notification', send):
+        await asyncio.gather(
+            scheduler.dispatch_notifications(MagicMock(), 8 * 60),
+            scheduler.dispatch_notifications(MagicMock(), 8 * 60 + 1),
+        )
+    assert peak == scheduler.MAX_CONCURRENT_NOTIFICATIONS
+
+def test_parse_slot_matches_strptime():
+    for slot in ("12:00 AM", "12:30 PM", "08:05 AM", "11:59 PM", "1:15 pm"):
+        parsed = datetime.strptime(slot, "%I:%M %p")
+        assert scheduler._parse_slot(slot) == (parsed.hour, parsed.minute)
+    for slot in ("13:00 PM", "00:30 AM", "08:60 AM", "08:30"):
+        with pytest.raises(ValueError):
+            scheduler._parse_slot(slot)
+
+def test_second_notification_wraps_past_midnight():
+    assert scheduler.slot_minutes(23, 45) == (23 * 60 + 45, 15)
+
+@pytest.mark.asyncio
+async def test_persistence_update_user_data_many_commits_in_one_batch(tmp_path):
+    db_path = tmp_path / "bot_data.db"
+    persistence = SQLitePersistence(filepath=str(db_path))
+    try:
+        await persistence.update_user_data_many([
+            (1, {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"}),
+            (2, {"home_crs": "LDS"}),
+        ])
+        with sqlite3.connect(db_path) as conn:
+            assert conn.execute("SELECT user_id FROM user_data ORDER BY user_id").fetchall() == [(1,), (2,)]
+            assert conn.execute("SELECT user_id, slot_type FROM schedule_slots").fetchall() == [(1, "to_slot")]
+        conn.close()
+        assert await persistence.get_user_data() == {1: {"home_crs": "MAN", "office_crs": "LDS", "to_slot": "08:30 AM"}, 2: {"home_crs": "LDS"}}
+    finally:
+        persistence.close()